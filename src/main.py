@@ -1,6 +1,12 @@
 import asyncio
-import json
-import uuid
+import collections
+import contextlib
+import os
+
+try:
+    import orjson as json
+except ImportError:
+    import json
 
 import scrypted_sdk
 from scrypted_sdk import (
@@ -15,6 +21,7 @@ from scrypted_sdk import (
     HttpResponse,
     Settings,
     Setting,
+    SettingValue,
     VideoCamera,
     ResponseMediaStreamOptions,
     RequestMediaStreamOptions,
@@ -24,12 +31,73 @@ from scrypted_sdk import (
 
 PLUGIN_NATIVE_ID = "@scrypted/whip"
 
+# how long a signaling session waits for a WHIP client to post its offer
+OFFER_TIMEOUT = 30
+
+# SDPs are small, but the body arrives as a JSON-encoded Buffer where each
+# byte takes up to four characters, so leave room for that expansion
+MAX_BODY_SIZE = 256 * 1024
+
+# upper bound on signaling requests a single device handles at once
+MAX_CONCURRENT_REQUESTS = 16
+
+# constant RPC arguments and return values, serialized by Scrypted and never
+# mutated, so build them once
+_SCRYPTED_SETUP = {
+    "type": "answer",
+    "audio": {
+        "direction": "recvonly",
+    },
+    "video": {
+        "direction": "recvonly",
+    },
+    "configuration": {
+        "iceServers": [
+            {"urls": ["stun:stun.l.google.com:19302"]},
+        ],
+        "iceCandidatePoolSize": 0,
+    }
+}
+_PLUGIN_SETUP = {}
+
+_VIDEO_STREAM_OPTIONS = [
+    {
+        "id": 'default',
+        "name": 'WHIP',
+        "container": 'rtsp',
+        "video": {
+            "codec": 'h264',
+        },
+        "audio": {
+            "codec": 'pcm_alaw',
+        },
+        "source": 'local',
+        "tool": 'scrypted',
+        "userConfigurable": False,
+    },
+]
+_CREATE_DEVICE_SETTINGS = [
+    {
+        'title': 'Name',
+        'key': 'name'
+    }
+]
+
+
+# the server ports are fixed for the lifetime of the plugin. the IP address
+# can change at runtime, so it is looked up on every call
+_component_cache = {}
+
+async def get_component(name: str) -> scrypted_sdk.Any:
+    if name not in _component_cache:
+        _component_cache[name] = await scrypted_sdk.systemManager.getComponent(name)
+    return _component_cache[name]
 
 async def https_port() -> int:
-    return await scrypted_sdk.systemManager.getComponent('SCRYPTED_SECURE_PORT')
+    return await get_component('SCRYPTED_SECURE_PORT')
 
 async def http_port() -> int:
-    return await scrypted_sdk.systemManager.getComponent('SCRYPTED_INSECURE_PORT')
+    return await get_component('SCRYPTED_INSECURE_PORT')
 
 async def server_ip() -> str:
     ip = await scrypted_sdk.systemManager.getComponent('SCRYPTED_IP_ADDRESS')
@@ -37,6 +105,30 @@ async def server_ip() -> str:
         return f"[{ip}]"
     return ip
 
+if hasattr(asyncio, "timeout"):
+    timeout = asyncio.timeout
+else:
+    # minimal stand-in for asyncio.timeout on python < 3.11
+    @contextlib.asynccontextmanager
+    async def timeout(delay: float):
+        task = asyncio.current_task()
+        expired = False
+
+        def expire() -> None:
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        handle = asyncio.get_running_loop().call_later(delay, expire)
+        try:
+            yield
+        except asyncio.CancelledError:
+            if expired:
+                raise asyncio.TimeoutError()
+            raise
+        finally:
+            handle.cancel()
+
 async def endpoint_path(id: str | None) -> str:
     if not id:
         id = PLUGIN_NATIVE_ID
@@ -45,9 +137,15 @@ async def endpoint_path(id: str | None) -> str:
 
 class WHIPSession:
 
-    def __init__(self, offer: str, resolve_answer: asyncio.Future) -> None:
+    def __init__(self, offer: str) -> None:
         self.offer = offer
-        self.resolve_answer = resolve_answer
+        self._answer: str | None = None
+        self._ready = asyncio.Event()
+        self.abandoned = False
+
+    async def wait_answer(self) -> str:
+        await self._ready.wait()
+        return self._answer
 
     async def createLocalDescription(self, type, setup, sendIceCandidate=None) -> dict:
         if type != "offer":
@@ -60,7 +158,10 @@ class WHIPSession:
     async def setRemoteDescription(self, description, setup) -> None:
         if description["type"] != "answer":
             raise Exception("can only accept answers in WHIPSession.setRemoteDescription")
-        self.resolve_answer.set_result(description["sdp"])
+        if self.abandoned:
+            raise Exception("WHIP client abandoned the session before the answer arrived")
+        self._answer = description["sdp"]
+        self._ready.set()
 
 
 class WHIPSessionControl:
@@ -78,134 +179,151 @@ class WHIPSessionControl:
         pass
 
 
+# session control is stateless, so every session can share one instance
+_SESSION_CONTROL = WHIPSessionControl()
+
+
 class WHIPDevice(ScryptedDeviceBase, HttpRequestHandler, Settings, VideoCamera):
 
     def __init__(self, nativeId: str | None = None) -> None:
         super().__init__(nativeId)
-        self.pending_webrtc = asyncio.Queue()
+        self.pending_webrtc: collections.deque[asyncio.Future] = collections.deque()
+        self.request_limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
     async def getSettings(self) -> list[Setting]:
-        ip = await server_ip()
-        endpoint = await endpoint_path(self.id)
+        ip, httpsp, httpp, endpoint = await asyncio.gather(
+            server_ip(), https_port(), http_port(), endpoint_path(self.id)
+        )
         return [
             {
                 "title": "HTTP endpoint",
                 "key": "http_endpoint",
                 "description": "HTTP ingestion endpoint",
-                "value": f"http://{ip}:{await http_port()}{endpoint}",
+                "value": f"http://{ip}:{httpp}{endpoint}",
                 "readonly": True,
             },
             {
                 "title": "HTTPS endpoint",
                 "key": "https_endpoint",
                 "description": "HTTPS ingestion endpoint",
-                "value": f"https://{ip}:{await https_port()}{endpoint}",
+                "value": f"https://{ip}:{httpsp}{endpoint}",
                 "readonly": True,
             },
+            {
+                "title": "Log SDP",
+                "key": "debug_sdp",
+                "description": "Log the camera offer and Scrypted answer SDPs for each session",
+                "type": "boolean",
+                "value": self.debug_sdp,
+            },
         ]
 
+    async def putSetting(self, key: str, value: SettingValue) -> None:
+        if key == "debug_sdp":
+            self.storage.setItem(key, "true" if value in (True, "true") else "false")
+        await self.onDeviceEvent(ScryptedInterface.Settings.value, None)
+
+    @property
+    def debug_sdp(self) -> bool:
+        return self.storage.getItem("debug_sdp") == "true"
+
     async def startRTCSignalingSession(self, scrypted_session):
-        offer_fut = asyncio.Future()
-        self.pending_webrtc.put_nowait(offer_fut)
+        offer_fut = asyncio.get_running_loop().create_future()
+        self.pending_webrtc.append(offer_fut)
 
         try:
-            offer, answer_fut = await asyncio.wait_for(offer_fut, timeout=60)
+            async with timeout(OFFER_TIMEOUT):
+                camera_session: WHIPSession = await offer_fut
         except asyncio.TimeoutError:
             self.print("Timeout waiting for camera offer")
             raise
         except asyncio.CancelledError:
             self.print("Session cancelled")
             raise
+        finally:
+            try:
+                self.pending_webrtc.remove(offer_fut)
+            except ValueError:
+                pass
 
-        camera_session = WHIPSession(offer, answer_fut)
-
-        scrypted_setup = {
-            "type": "answer",
-            "audio": {
-                "direction": "recvonly",
-            },
-            "video": {
-                "direction": "recvonly",
-            },
-            "configuration": {
-                "iceServers": [
-                    {"urls": ["stun:stun.l.google.com:19302"]},
-                ],
-                "iceCandidatePoolSize": 0,
-            }
-        }
-        plugin_setup = {}
-
+        debug_sdp = self.debug_sdp
         try:
-            camera_offer = await camera_session.createLocalDescription("offer", plugin_setup)
-            self.print(f"Camera offer sdp:\n{camera_offer['sdp']}")
-            await scrypted_session.setRemoteDescription(camera_offer, scrypted_setup)
-            scrypted_offer = await scrypted_session.createLocalDescription("answer", scrypted_setup)
-            self.print(f"Scrypted answer sdp:\n{scrypted_offer['sdp']}")
-            await camera_session.setRemoteDescription(scrypted_offer, plugin_setup)
+            camera_offer = await camera_session.createLocalDescription("offer", _PLUGIN_SETUP)
+            if debug_sdp:
+                self.print(f"Camera offer sdp:\n{camera_offer['sdp']}")
+            await scrypted_session.setRemoteDescription(camera_offer, _SCRYPTED_SETUP)
+            scrypted_offer = await scrypted_session.createLocalDescription("answer", _SCRYPTED_SETUP)
+            if debug_sdp:
+                self.print(f"Scrypted answer sdp:\n{scrypted_offer['sdp']}")
+            await camera_session.setRemoteDescription(scrypted_offer, _PLUGIN_SETUP)
         except Exception as e:
             self.print(f"Error setting up session: {e}")
             raise
 
-        return WHIPSessionControl()
+        return _SESSION_CONTROL
 
     async def onRequest(self, request: HttpRequest, response: HttpResponse) -> None:
         if not request.get("body") or request["body"] == "{}":
             return
 
-        try:
-            # body is parsed as a Buffer, convert to string
-            body = json.loads(request["body"])
-            body = bytearray(body.get("data", "")).decode("utf-8")
-
-            if not body:
-                response.send("No SDP provided", { "code": 400 })
-                return
-
-            # do we have a pending connection?
-            if self.pending_webrtc.empty():
-                response.send("No pending connection", { "code": 503 })
-                return
-
-            offer_fut: asyncio.Future = None
-            while not self.pending_webrtc.empty():
-                offer_fut = self.pending_webrtc.get_nowait()
-                if not offer_fut.done():
-                    break
-
-            if not offer_fut:
-                response.send("No pending connection", { "code": 503 })
-                return
-
-            answer_fut = asyncio.Future()
-            offer_fut.set_result((body, answer_fut))
-
-            answer = await asyncio.wait_for(answer_fut, timeout=1)
-            response.send(answer, { "code": 201 })
-        except asyncio.TimeoutError:
-            self.print("Timeout waiting for Scrypted answer")
-            response.send("Timeout waiting for answer", { "code": 504 })
-        except Exception as e:
-            self.print(f"Error processing request: {e}")
-            response.send(f"Error processing request", { "code": 500 })
+        if len(request["body"]) > MAX_BODY_SIZE:
+            response.send("Body too large", { "code": 413 })
+            return
+
+        # fail fast rather than queueing when the device is saturated
+        if self.request_limit.locked():
+            response.send("Too many pending requests", { "code": 503 })
+            return
+
+        async with self.request_limit:
+            try:
+                # body is parsed as a Buffer, convert to string. the raw body is
+                # handed to the parser as-is, since it accepts str and bytes alike
+                body = json.loads(request["body"])
+                data = body.get("data", "")
+                if isinstance(data, str):
+                    body = data
+                elif isinstance(data, (bytes, bytearray)):
+                    body = data.decode("utf-8")
+                else:
+                    body = bytes(data).decode("utf-8")
+
+                if not body:
+                    response.send("No SDP provided", { "code": 400 })
+                    return
+
+                # do we have a pending connection?
+                while self.pending_webrtc:
+                    offer_fut = self.pending_webrtc.popleft()
+                    if not offer_fut.done():
+                        break
+                else:
+                    offer_fut = None
+
+                if not offer_fut:
+                    response.send("No pending connection", { "code": 503 })
+                    return
+
+                camera_session = WHIPSession(body)
+                offer_fut.set_result(camera_session)
+
+                try:
+                    async with timeout(1):
+                        answer = await camera_session.wait_answer()
+                except BaseException:
+                    # the client is gone, so fail the session if scrypted answers late
+                    camera_session.abandoned = True
+                    raise
+                response.send(answer, { "code": 201 })
+            except asyncio.TimeoutError:
+                self.print("Timeout waiting for Scrypted answer")
+                response.send("Timeout waiting for answer", { "code": 504 })
+            except Exception as e:
+                self.print(f"Error processing request: {e}")
+                response.send(f"Error processing request", { "code": 500 })
 
     async def getVideoStreamOptions(self) -> list[ResponseMediaStreamOptions]:
-        return [
-            {
-                "id": 'default',
-                "name": 'WHIP',
-                "container": 'rtsp',
-                "video": {
-                    "codec": 'h264',
-                },
-                "audio": {
-                    "codec": 'pcm_alaw',
-                },
-                "source": 'local',
-                "tool": 'scrypted',
-                "userConfigurable": False,
-            },
-        ]
+        return _VIDEO_STREAM_OPTIONS
 
     async def getVideoStream(self, options: RequestMediaStreamOptions = None) -> MediaObject:
         return await scrypted_sdk.mediaManager.createMediaObject(self, ScryptedMimeTypes.RTCSignalingChannel.value)
@@ -218,16 +336,17 @@ class WHIPPlugin(ScryptedDeviceBase, DeviceProvider, DeviceCreator):
         self.devices = {}
 
     async def getDevice(self, nativeId: str) -> scrypted_sdk.Any:
-        if nativeId not in self.devices:
-            self.devices[nativeId] = WHIPDevice(nativeId)
-        return self.devices[nativeId]
+        device = self.devices.get(nativeId)
+        if device is None:
+            device = self.devices[nativeId] = WHIPDevice(nativeId)
+        return device
 
     async def releaseDevice(self, id: str, nativeId: str) -> None:
         if nativeId in self.devices:
             del self.devices[nativeId]
 
     async def createDevice(self, settings: DeviceCreatorSettings) -> str:
-        nativeId = str(uuid.uuid4().hex)
+        nativeId = os.urandom(16).hex()
         name = settings.get("name", "New WHIP Camera")
         await scrypted_sdk.deviceManager.onDeviceDiscovered({
             'nativeId': nativeId,
@@ -243,12 +362,7 @@ class WHIPPlugin(ScryptedDeviceBase, DeviceProvider, DeviceCreator):
         return nativeId
 
     async def getCreateDeviceSettings(self) -> list[Setting]:
-        return [
-            {
-                'title': 'Name',
-                'key': 'name'
-            }
-        ]
+        return _CREATE_DEVICE_SETTINGS
 
 def create_scrypted_plugin():
     return WHIPPlugin()
\ No newline at end of file